@@ -1,40 +1,127 @@
 import os
-import re
+import shutil
 import csv
-from datetime import datetime
-
-from flask import Flask, request, jsonify, send_from_directory
+import multiprocessing
+import hashlib
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+
+from flask import Flask, Response, request
+from flask.json.provider import JSONProvider
+import orjson
 import pdfplumber
 from PIL import Image
 import pytesseract
 import numpy as np
 from flask_cors import CORS
 
+from bill_parser import parse_bill_text
+
+
+class OrjsonProvider(JSONProvider):
+    # 用 orjson 代替标准库 json，request.get_json 也走这里
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
+_UTC = timezone.utc
+
 # 日志文件
 WTP_LOG = "wtp_log.csv"
 EVENT_LOG = "event_log.csv"
+LOG_FIELDS = {
+    WTP_LOG: ("timestamp", "choice", "reason", "user_id"),
+    EVENT_LOG: ("timestamp", "event_type", "user_id", "extra"),
+}
 
 # 上传目录
 UPLOAD_FOLDER = "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def available_cpus():
+    # os.cpu_count() 在容器里报的是宿主机核数；能用 affinity 就用 affinity
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# 并发 tesseract 数 = UPLOAD_WORKERS × OCR_PAGE_THREADS；容器 CPU 配额 affinity 看不到，
+# 小实例上用环境变量显式调小
+_CPUS = available_cpus()
+OCR_PAGE_THREADS = int(os.environ.get("OCR_PAGE_THREADS", min(_CPUS, 4)))
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", max(1, _CPUS // OCR_PAGE_THREADS)))
+
+
+def new_upload_executor():
+    # forkserver：池进程从干净的 server 进程 fork，而不是从带着请求线程 / executor 管理线程的 Web 进程 fork
+    return ProcessPoolExecutor(
+        max_workers=UPLOAD_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver"),
+    )
+
+
+# 上传后的 OCR 放到进程池里做，不占用 Web worker；job_id -> Future
+_EXECUTOR = new_upload_executor()
+_EXECUTOR_LOCK = threading.Lock()
+_UPLOAD_JOBS = {}
+# job_id -> 提交 / 完成时间；完成后超过 UPLOAD_JOB_TTL 秒还没人取的结果直接丢掉，
+# 提交后超过 UPLOAD_JOB_TTL 秒还没完成的任务（卡住或排队太久）也一并清掉
+_UPLOAD_JOB_SUBMITTED_AT = {}
+_UPLOAD_JOB_DONE_AT = {}
+_UPLOAD_JOBS_LOCK = threading.Lock()
+UPLOAD_JOB_TTL = 600
+
+
+def open_csv_log(path, fieldnames):
+    # 常驻的行缓冲追加句柄：每条日志只有一次 write，不再每次 open/stat/close
+    f = open(path, "a", buffering=1, newline="", encoding="utf-8")
+    writer = csv.writer(f)
+    if os.path.getsize(path) == 0:
+        writer.writerow(fieldnames)
+    return f, writer, threading.Lock(), fieldnames
+
+
+_CSV_LOGS = {path: open_csv_log(path, fields) for path, fields in LOG_FIELDS.items()}
+
+
+def fastjson(obj):
+    return app.response_class(orjson.dumps(obj), mimetype="application/json")
 
 
 def append_csv(path, row):
-    file_exists = os.path.isfile(path)
-    with open(path, "a", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=row.keys())
-        if not file_exists:
-            writer.writeheader()
-        writer.writerow(row)
+    _, writer, lock, fieldnames = _CSV_LOGS[path]
+    with lock:
+        writer.writerow([row.get(k, "") for k in fieldnames])
+
+
+# 首页是单个静态文件：启动时读进内存并算好 ETag，请求时不再 stat/读盘
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.html"), "rb") as f:
+    _INDEX = f.read()
+_INDEX_ETAG = hashlib.md5(_INDEX).hexdigest()
 
 
 @app.route("/")
 def serve_index():
-    return send_from_directory(".", "index.html")
+    headers = {"ETag": f'"{_INDEX_ETAG}"'}
+    # If-None-Match 按 RFC 7232 做弱比较（gzip 代理会把 ETag 改成 W/"..."）
+    if request.if_none_match.contains_weak(_INDEX_ETAG):
+        return Response(status=304, headers=headers)
+    return Response(_INDEX, mimetype="text/html", headers=headers)
 
 
 @app.route("/health", methods=["GET"])
@@ -61,7 +148,7 @@ def get_decoded_bill():
             "Billed amount is roughly 2x the usual range for this MRI in this ZIP code."
         ]
     }
-    return jsonify(data)
+    return fastjson(data)
 
 
 @app.route("/api/action_plan", methods=["GET"])
@@ -91,7 +178,7 @@ def get_action_plan():
             "Save any emails or letters you send or receive."
         ]
     }
-    return jsonify(data)
+    return fastjson(data)
 
 
 @app.route("/api/wtp", methods=["POST"])
@@ -100,7 +187,7 @@ def post_wtp():
     choice = payload.get("choice")
     reason = payload.get("reason", "")
     user_id = payload.get("user_id", "")
-    ts = datetime.utcnow().isoformat()
+    ts = datetime.now(_UTC).isoformat(timespec="seconds")
 
     row = {
         "timestamp": ts,
@@ -109,7 +196,7 @@ def post_wtp():
         "user_id": user_id
     }
     append_csv(WTP_LOG, row)
-    return jsonify({"status": "ok"})
+    return fastjson({"status": "ok"})
 
 
 @app.route("/api/session_event", methods=["POST"])
@@ -118,7 +205,7 @@ def post_event():
     event_type = payload.get("event_type", "")
     user_id = payload.get("user_id", "")
     extra = payload.get("extra", {})
-    ts = datetime.utcnow().isoformat()
+    ts = datetime.now(_UTC).isoformat(timespec="seconds")
 
     row = {
         "timestamp": ts,
@@ -127,406 +214,304 @@ def post_event():
         "extra": str(extra)
     }
     append_csv(EVENT_LOG, row)
-    return jsonify({"status": "ok"})
-
-
-def extract_text_from_file(path: str) -> str:
-    ext = os.path.splitext(path)[1].lower()
-
-    # PDF：先尝试 pdfplumber 提取文字，如果失败则用 OCR
-    if ext in [".pdf"]:
-        text_parts = []
-        with pdfplumber.open(path) as pdf:
+    return fastjson({"status": "ok"})
+
+
+# 扫描版 PDF 的 OCR 参数：200 DPI 灰度对账单足够；LSTM 引擎 + 整块文本版面
+OCR_RESOLUTION = 200
+OCR_CONFIG = "--oem 1 --psm 6"
+# 单个上传任务（含排队）的 OCR 总时限，要小于前端 120 秒的轮询上限
+OCR_JOB_TIMEOUT = 100
+# 并发已经由线程池 / 进程池控制，每个 tesseract 只用一个 OpenMP 线程
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+def ocr_timeout(deadline):
+    # pytesseract 的 timeout=0 表示不限时；过了 deadline 就不再启动新的 tesseract
+    if deadline is None:
+        return 0
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise RuntimeError("OCR time limit exceeded")
+    return remaining
+
+
+def ocr_page_image(img, deadline=None):
+    return pytesseract.image_to_string(img, config=OCR_CONFIG, timeout=ocr_timeout(deadline))
+
+
+# PDF：先尝试 pdfplumber 提取文字，如果失败则用 OCR
+def extract_pdf_text(path: str, deadline=None) -> str:
+    text_parts = []
+    # 提取不到文字的页（扫描件）在同一个 pdf 句柄里直接转成图片，渲染完马上交给线程池 OCR；
+    # 信号量限制同时在内存里的页图片数，OCR 完一页才渲染下一页
+    ocr_futures = []
+    with pdfplumber.open(path) as pdf:
+        workers = max(1, min(len(pdf.pages), OCR_PAGE_THREADS))
+        slots = threading.BoundedSemaphore(workers)
+        with ThreadPoolExecutor(max_workers=workers) as ex:
             for page in pdf.pages:
                 t = page.extract_text() or ""
-                text_parts.append(t)
-
-        combined_text = "\n".join(text_parts).strip()
-
-        # 如果 pdfplumber 提取不到文字（扫描件），用 OCR
-        if not combined_text:
-            try:
-                with pdfplumber.open(path) as pdf:
-                    for page in pdf.pages:
-                        # 将 PDF 页面转为图片再 OCR
-                        img = page.to_image(resolution=300).original
-                        t = pytesseract.image_to_string(img)
+                if not t.strip():
+                    slots.acquire()
+                    if deadline is not None and time.time() >= deadline:
+                        # 已经超时：剩下的页不再渲染
+                        slots.release()
+                        print("OCR fallback failed: OCR time limit exceeded")
                         text_parts.append(t)
-                combined_text = "\n".join(text_parts)
-            except Exception as e:
-                print(f"OCR fallback failed: {e}")
-
-        return combined_text
+                        continue
+                    try:
+                        img = page.to_image(resolution=OCR_RESOLUTION).original.convert("L")
+                    except Exception as e:
+                        slots.release()
+                        print(f"OCR fallback failed: {e}")
+                    else:
+                        fut = ex.submit(ocr_page_image, img, deadline)
+                        del img
+                        fut.add_done_callback(lambda _: slots.release())
+                        ocr_futures.append((len(text_parts), fut))
+                text_parts.append(t)
 
-    # 图片：用 pytesseract 做 OCR
-    # 支持多种图片格式，包括 HEIC/HEIF (iPhone)
-    image_extensions = [".png", ".jpg", ".jpeg", ".tiff", ".bmp", ".gif", ".webp", ".heic", ".heif"]
-    if ext in image_extensions:
+    # 按页序回填 OCR 结果
+    for i, fut in ocr_futures:
         try:
-            # 尝试打开图片
-            img = Image.open(path)
+            text_parts[i] = fut.result()
         except Exception as e:
-            # 如果打开失败，尝试用 pillow-heif 处理 HEIC/HEIF
-            if ext in [".heic", ".heif"]:
-                try:
-                    import pillow_heif
-                    heif_file = pillow_heif.read_heif(path)
-                    img = Image.frombytes(
-                        heif_file.mode,
-                        heif_file.size,
-                        heif_file.data,
-                        "raw"
-                    )
-                except ImportError:
-                    print(f"pillow-heif not installed, cannot process HEIC/HEIF")
-                    return ""
-                except Exception as heif_err:
-                    print(f"HEIC processing failed: {heif_err}")
-                    return ""
-            else:
-                # 尝试忽略扩展名，让 PIL 自动检测格式
-                try:
-                    with open(path, 'rb') as f:
-                        img = Image.open(f)
-                        img.load()  # 强制加载
-                except Exception as e2:
-                    print(f"Image open failed: {e} / {e2}")
-                    return ""
-
-        # 确保图片是 RGB 模式 (OCR 需要)
-        try:
-            if img.mode in ('RGBA', 'LA', 'P'):
-                # 有透明通道，转换为白底 RGB
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-            elif img.mode != 'RGB':
-                img = img.convert('RGB')
-        except Exception as convert_err:
-            print(f"Image conversion failed: {convert_err}")
-            # 继续尝试 OCR
-
-        # Convert PIL Image to numpy array for pytesseract compatibility
-        img_array = np.array(img)
-        text = pytesseract.image_to_string(img_array)
-        return text
+            print(f"OCR fallback failed: {e}")
 
+    combined_text = "\n".join(text_parts).strip()
+    return combined_text
+
+
+# 图片：用 pytesseract 做 OCR
+def extract_image_text(path: str, deadline=None) -> str:
+    try:
+        # 尝试打开图片
+        img = Image.open(path)
+    except Exception as e:
+        # 如果打开失败，尝试用 pillow-heif 处理 HEIC/HEIF
+        if os.path.splitext(path)[1].lower() in _HEIC_EXTS:
+            try:
+                import pillow_heif
+                heif_file = pillow_heif.read_heif(path)
+                img = Image.frombytes(
+                    heif_file.mode,
+                    heif_file.size,
+                    heif_file.data,
+                    "raw"
+                )
+            except ImportError:
+                print(f"pillow-heif not installed, cannot process HEIC/HEIF")
+                return ""
+            except Exception as heif_err:
+                print(f"HEIC processing failed: {heif_err}")
+                return ""
+        else:
+            # 尝试忽略扩展名，让 PIL 自动检测格式
+            try:
+                with open(path, 'rb') as f:
+                    img = Image.open(f)
+                    img.load()  # 强制加载
+            except Exception as e2:
+                print(f"Image open failed: {e} / {e2}")
+                return ""
+
+    # 确保图片是 RGB 模式 (OCR 需要)
+    try:
+        if img.mode in ('RGBA', 'LA', 'P'):
+            # 有透明通道，转换为白底 RGB
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            if img.mode == 'P':
+                img = img.convert('RGBA')
+            background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+    except Exception as convert_err:
+        print(f"Image conversion failed: {convert_err}")
+        # 继续尝试 OCR
+
+    # Convert PIL Image to numpy array for pytesseract compatibility
+    img_array = np.array(img)
+    text = pytesseract.image_to_string(img_array, timeout=ocr_timeout(deadline))
+    return text
+
+
+# 支持多种图片格式，包括 HEIC/HEIF (iPhone)
+_PDF_EXTS = frozenset({".pdf"})
+_IMG_EXTS = frozenset({".png", ".jpg", ".jpeg", ".tiff", ".bmp", ".gif", ".webp", ".heic", ".heif"})
+_HEIC_EXTS = frozenset({".heic", ".heif"})
+_EXT_DISPATCH = {
+    **{ext: extract_pdf_text for ext in _PDF_EXTS},
+    **{ext: extract_image_text for ext in _IMG_EXTS},
+}
+
+
+def extract_text_from_file(path: str, deadline=None) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    handler = _EXT_DISPATCH.get(ext)
     # 其他类型暂时返回空
-    return ""
+    return handler(path, deadline) if handler else ""
 
 
-def parse_bill_text(text: str) -> dict:
+def process_upload(save_path, submitted_at):
     """
-    规则解析 v3：
-    - 先按行预处理和分类
-    - 优先从“明细行”和“带关键字的 total 行”抓金额
-    - 尝试区分 service date / statement date
+    在后台进程里跑：OCR/文本抽取，返回 (payload, status code)；成功时 payload 为 {"text": ...}。
+    解析留给 Web 进程做，这样 parse_bill_text 的 LRU 缓存是所有任务共享的一份，
+    而不是每个池进程各有一份。
     """
+    # 时限从提交时算起：排队太久、前端已经放弃的任务直接跳过
+    deadline = submitted_at + OCR_JOB_TIMEOUT
+    try:
+        if time.time() >= deadline:
+            return {"error": "timed out waiting for OCR"}, 504
+
+        text = extract_text_from_file(save_path, deadline)
+        print(f"[upload_bill] Extracted text length: {len(text) if text else 0}")
+
+        if not text.strip():
+            return {"error": "could not extract text from file"}, 400
+
+        return {"text": text}, 200
+
+    except Exception as e:
+        import traceback
+        error_msg = f"Error processing file: {str(e)}"
+        print(f"[upload_bill] ERROR: {error_msg}")
+        print(traceback.format_exc())
+        return {"error": error_msg}, 500
+
+    finally:
+        # 文本已经拿到（或失败），原文件不再需要
+        remove_upload(save_path)
+
+
+def remove_upload(save_path):
+    try:
+        os.remove(save_path)
+    except OSError:
+        pass
+
+
+def submit_upload_job(save_path):
+    global _EXECUTOR
+    submitted_at = time.time()
+    with _EXECUTOR_LOCK:
+        try:
+            fut = _EXECUTOR.submit(process_upload, save_path, submitted_at)
+        except BrokenProcessPool:
+            # 某个 worker 被杀掉（比如 OCR 时 OOM）后进程池就一直是坏的，重建一个
+            print("[upload_bill] Process pool broken, recreating")
+            _EXECUTOR.shutdown(wait=False)
+            _EXECUTOR = new_upload_executor()
+            fut = _EXECUTOR.submit(process_upload, save_path, submitted_at)
+    # 被 sweep 取消、或 worker 中途挂掉的任务走不到 process_upload 的 finally，这里兜底再删一次
+    fut.add_done_callback(lambda _: remove_upload(save_path))
+    return fut
+
+
+def track_upload_job(job_id, fut):
+    def mark_done(_):
+        with _UPLOAD_JOBS_LOCK:
+            if job_id in _UPLOAD_JOBS:
+                _UPLOAD_JOB_DONE_AT[job_id] = time.monotonic()
+
+    with _UPLOAD_JOBS_LOCK:
+        _UPLOAD_JOBS[job_id] = fut
+        _UPLOAD_JOB_SUBMITTED_AT[job_id] = time.monotonic()
+    fut.add_done_callback(mark_done)
+
+
+def pop_upload_job(job_id):
+    with _UPLOAD_JOBS_LOCK:
+        _UPLOAD_JOB_SUBMITTED_AT.pop(job_id, None)
+        _UPLOAD_JOB_DONE_AT.pop(job_id, None)
+        return _UPLOAD_JOBS.pop(job_id, None)
+
+
+def sweep_upload_jobs():
+    cutoff = time.monotonic() - UPLOAD_JOB_TTL
+    with _UPLOAD_JOBS_LOCK:
+        expired = {job_id for job_id, done_at in _UPLOAD_JOB_DONE_AT.items() if done_at < cutoff}
+        expired.update(job_id for job_id, submitted_at in _UPLOAD_JOB_SUBMITTED_AT.items() if submitted_at < cutoff)
+        dropped = []
+        for job_id in expired:
+            _UPLOAD_JOB_SUBMITTED_AT.pop(job_id, None)
+            _UPLOAD_JOB_DONE_AT.pop(job_id, None)
+            dropped.append(_UPLOAD_JOBS.pop(job_id, None))
+    # 还在排队的直接取消；已经在跑的由 OCR 时限兜底。
+    # cancel() 会同步触发 done callback（要拿同一把锁），所以放在锁外面
+    for fut in dropped:
+        if fut is not None:
+            fut.cancel()
 
-    lines_raw = text.splitlines()
-    lines = [l.strip() for l in lines_raw if l.strip()]
-
-    # -------- provider 猜测：header 前几行里像机构名的 --------
-    provider = ""
-    provider_candidates = []
-    header_window = lines[:12]
-    for line in header_window:
-        if any(x in line for x in ["Patient", "Insurance", "Billing", "Statement", "Account", "Invoice", "Guarantor"]):
-            continue
-        if any(x in line for x in ["Center", "Clinic", "Hospital", "Medical", "Imaging", "Health", "Care"]):
-            provider_candidates.append(line.strip())
-
-    if provider_candidates:
-        provider = min(provider_candidates, key=len)
-
-    # -------- 日期解析：优先带 service/visit 的行，其次任意日期 --------
-    date_pattern = r"(\d{1,2}[/-]\d{1,2}[/-]\d{2,4}|\d{4}-\d{2}-\d{2})"
-    service_date = ""
-    fallback_date = ""
-
-    for line in lines:
-        m = re.search(date_pattern, line)
-        if not m:
-            continue
-        d = m.group(1)
-        lower = line.lower()
-        if any(k in lower for k in ["service date", "date of service", "dos", "visit date"]):
-            service_date = d
-            break
-        if not fallback_date:
-            fallback_date = d
-
-    if not service_date:
-        service_date = fallback_date
-
-    # -------- procedure / CPT：优先 CPT xxx，其次 5 位代码出现在明细行 --------
-    cpt_pattern = r"(CPT\s*\d{4,5})"
-    cpt_match = re.search(cpt_pattern, text, re.IGNORECASE)
-    procedure = ""
-    if cpt_match:
-        procedure = cpt_match.group(1)
-    else:
-        # 没有显式 CPT，就找一行里有 5 位数字 + 金额的行
-        code_line = ""
-        for line in lines:
-            if re.search(r"\b\d{5}\b", line) and re.search(r"\d+\.\d{2}", line):
-                code_line = line
-                break
-        if code_line:
-            m = re.search(r"\b\d{5}\b", code_line)
-            if m:
-                procedure = m.group(0)
-
-    if not procedure:
-        procedure = "Unknown procedure"
-
-    # -------- 金额匹配：允许逗号，统一成 float --------
-    # Pattern 1: with dollar sign (most reliable) - e.g., $7,353.60
-    dollar_amount_pattern = r"\$\s*([0-9]+(?:,[0-9]{3})*\.[0-9]{2})"
-    # Pattern 2: without dollar sign but with decimal point - e.g., 7,353.60
-    plain_amount_pattern = r"([0-9]+(?:,[0-9]{3})*\.[0-9]{2})"
-    # Pattern 3: European/OCR format with comma as decimal - e.g., 7,353,60
-    comma_decimal_pattern = r"([0-9]+(?:,[0-9]{3})*),([0-9]{2})\b"
-
-    def extract_amounts(line: str, prefer_dollar=False):
-        """Extract amounts from a line. If prefer_dollar=True, only return $ amounts (empty list if none found)."""
-        # First try to find amounts with $ sign
-        dollar_matches = re.findall(dollar_amount_pattern, line)
-        dollar_vals = [float(m.replace(",", "")) for m in dollar_matches]
-        dollar_vals = [v for v in dollar_vals if 0 < v < 1000000]
-
-        # If prefer_dollar mode, return only dollar amounts (may be empty)
-        if prefer_dollar:
-            return dollar_vals
-
-        # Also find plain amounts
-        plain_matches = re.findall(plain_amount_pattern, line)
-        plain_vals = [float(m.replace(",", "")) for m in plain_matches]
-        plain_vals = [v for v in plain_vals if 0 < v < 1000000]
-
-        # Try comma-as-decimal format (e.g., "7,353,60" -> 7353.60)
-        comma_matches = re.findall(comma_decimal_pattern, line)
-        for whole, decimal in comma_matches:
-            try:
-                val = float(whole.replace(",", "") + "." + decimal)
-                if 0 < val < 1000000 and val not in plain_vals:
-                    plain_vals.append(val)
-            except ValueError:
-                pass
-
-        # Combine, preferring dollar amounts
-        all_vals = dollar_vals + [v for v in plain_vals if v not in dollar_vals]
-        return all_vals
-
-    all_amounts = []
-    for line in lines:
-        all_amounts.extend(extract_amounts(line))
-
-    all_amounts_clean = all_amounts[:]
-
-    billed_amount = 0.0
-    allowed_amount = 0.0
-    printed_owe = 0.0
-    insurer_paid = 0.0
-
-    # -------- 先找 total / amount due / allowed / plan paid 等聚合行 --------
-    # For patient owe, prefer dollar-sign amounts (more reliable with OCR)
-    printed_owe_candidates = []
-
-    for line in lines:
-        lower = line.lower()
-        vals = extract_amounts(line)
-        if not vals:
-            continue
-
-        # total charges / total amount / billed amount
-        if any(k in lower for k in ["total charges", "total amount", "total billed", "billed amount", "total lab charges"]):
-            cand = max(vals)
-            if cand > billed_amount:
-                billed_amount = cand
-
-        # patient responsibility / amount due / you owe / pay now / please pay
-        pay_keywords = ["amount due", "you owe", "amount you owe", "patient responsibility",
-                        "balance due", "pay this amount", "amount owed", "total due", "your balance"]
-        # Special handling for "pay X now" pattern
-        pay_now_keywords = ["pay now", "pay $"]
-
-        if any(k in lower for k in pay_keywords + pay_now_keywords):
-            # Prefer dollar amounts for payment lines (more reliable)
-            dollar_vals = extract_amounts(line, prefer_dollar=True)
-            if dollar_vals:
-                # Dollar amount found - use it
-                printed_owe_candidates.append(('dollar', max(dollar_vals), line))
-            elif vals:
-                # No dollar amount, use plain amount
-                printed_owe_candidates.append(('plain', max(vals), line))
-
-        # allowed
-        if any(k in lower for k in ["allowed amount", "plan allowed", "eligible amount"]):
-            cand = max(vals)
-            if cand > allowed_amount:
-                allowed_amount = cand
-
-        # insurance paid
-        if any(k in lower for k in ["insurance paid", "plan paid", "benefit paid", "insurance payment"]):
-            cand = max(vals)
-            if cand > insurer_paid:
-                insurer_paid = cand
-
-    # Select best printed_owe: prefer dollar amounts over plain amounts
-    dollar_candidates = [(amt, line) for (typ, amt, line) in printed_owe_candidates if typ == 'dollar']
-    plain_candidates = [(amt, line) for (typ, amt, line) in printed_owe_candidates if typ == 'plain']
-
-    if dollar_candidates:
-        # Use the dollar amount - if multiple, use the one from most specific context
-        printed_owe = max([amt for (amt, _) in dollar_candidates])
-    elif plain_candidates:
-        printed_owe = max([amt for (amt, _) in plain_candidates])
-
-    # -------- 再看“明细行”：行里同时有日期 + 代码 + 多个金额 --------
-    detail_lines = []
-    for line in lines:
-        if re.search(date_pattern, line) and re.search(r"\b\d{4,5}\b", line) and len(extract_amounts(line)) >= 2:
-            detail_lines.append(line)
-
-    # 针对第一条明细行：通常格式类似
-    # [date] [code] [desc...] [charge] [allowed] [plan paid] [you owe]
-    if detail_lines:
-        line = detail_lines[0]
-        vals = extract_amounts(line)
-        # 简单假设：最后一个是 you owe，倒数第二个是 plan paid，中间某个是 allowed，第一个最大的当 billed
-        if vals:
-            if billed_amount == 0.0:
-                billed_candidate = max(vals)
-                billed_amount = billed_candidate
-
-            # 可能结构：[charge, allowed, plan_paid, you_owe]
-            if len(vals) >= 4:
-                if printed_owe == 0.0:
-                    printed_owe = vals[-1]
-                if insurer_paid == 0.0:
-                    insurer_paid = vals[-2]
-                if allowed_amount == 0.0:
-                    allowed_amount = vals[-3]
-            elif len(vals) == 3:
-                # 结构可能是 [charge, plan_paid, you_owe]
-                if printed_owe == 0.0:
-                    printed_owe = vals[-1]
-                if insurer_paid == 0.0:
-                    insurer_paid = vals[-2]
-            elif len(vals) == 2:
-                # 最简单：[charge, you_owe]
-                if printed_owe == 0.0:
-                    printed_owe = vals[-1]
-
-    # -------- 没抓到就回退到全局逻辑 --------
-    # Filter out amounts that appear near account/reference numbers
-    # Account numbers often have amounts that look like prices
-    reasonable_amounts = [a for a in all_amounts_clean if a < 50000]  # Most medical bills < $50k
-
-    if reasonable_amounts:
-        if billed_amount == 0.0:
-            # If we already found printed_owe, use a reasonable multiple of it
-            if printed_owe > 0:
-                # billed is typically higher than patient owes, but not by crazy amounts
-                candidates = [a for a in reasonable_amounts if a >= printed_owe and a <= printed_owe * 5]
-                if candidates:
-                    billed_amount = min(candidates)  # Take the smallest reasonable candidate
-                else:
-                    billed_amount = printed_owe  # Fallback to printed_owe
-            else:
-                billed_amount = max(reasonable_amounts)
-
-        if printed_owe == 0.0:
-            if len(reasonable_amounts) >= 2:
-                printed_owe = sorted(reasonable_amounts, reverse=True)[1]
-            else:
-                printed_owe = billed_amount
-
-    if allowed_amount == 0.0 and billed_amount > 0:
-        allowed_amount = round(billed_amount * 0.65, 2)
-
-    if insurer_paid == 0.0 and allowed_amount > 0:
-        coinsurance_rate = 0.2
-        insurer_paid = max(0.0, allowed_amount * (1 - coinsurance_rate))
-
-    if printed_owe == 0.0:
-        printed_owe = billed_amount
-
-    # -------- 计算 should_owe 和 overcharge --------
-    # For statements/bills where we only see "amount due", the overcharge estimate
-    # is based on comparing to typical allowed amounts
-    coinsurance_rate = 0.2
-    if allowed_amount > 0 and billed_amount > allowed_amount:
-        # We have both billed and allowed - can calculate proper should_owe
-        should_owe = round(allowed_amount * coinsurance_rate, 2)
-    elif billed_amount > 0:
-        # We only have billed amount - estimate allowed as 65% of billed
-        estimated_allowed = billed_amount * 0.65
-        should_owe = round(estimated_allowed * coinsurance_rate, 2)
-    else:
-        should_owe = 0.0
-
-    estimated_overcharge = max(0.0, printed_owe - should_owe)
-
-    issues = []
-    if allowed_amount > 0 and billed_amount > allowed_amount * 1.5:
-        issues.append("Billed amount appears significantly higher than a typical allowed amount.")
-    if estimated_overcharge > 0:
-        issues.append("Patient responsibility looks higher than expected for a typical coinsurance rate.")
-
-    result = {
-        "provider": provider or "Unknown provider",
-        "service_date": service_date or "Unknown date",
-        "procedure": procedure or "Unknown procedure",
-        "billed_amount": round(billed_amount, 2),
-        "allowed_amount": round(allowed_amount, 2),
-        "insurer_paid": round(insurer_paid, 2),
-        "printed_owe": round(printed_owe, 2),
-        "should_owe": round(should_owe, 2),
-        "estimated_overcharge": round(estimated_overcharge, 2),
-        "issues": issues,
-        "raw_text": text
-    }
-    return result
 
 @app.route("/api/upload_bill", methods=["POST"])
 def upload_bill():
     """
-    接收 PDF 或图片，做 OCR/文本抽取 + 粗糙解析，返回 decoded 结果。
+    接收 PDF 或图片，存盘后把 OCR/解析丢给后台进程池，立即返回 job_id；
+    前端轮询 GET /api/upload_bill/<job_id> 拿 decoded 结果。
     """
     try:
         if "file" not in request.files:
-            return jsonify({"error": "no file field"}), 400
+            return fastjson({"error": "no file field"}), 400
 
         file = request.files["file"]
         if file.filename == "":
-            return jsonify({"error": "empty filename"}), 400
+            return fastjson({"error": "empty filename"}), 400
 
-        filename = file.filename
-        save_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        file.save(save_path)
+        # 后台任务稍后才读文件：按 job_id 存盘，避免同名上传（image.jpg / bill.pdf）互相覆盖
+        job_id = uuid.uuid4().hex
+        ext = os.path.splitext(file.filename)[1].lower()
+        save_path = os.path.join(app.config["UPLOAD_FOLDER"], f"{job_id}{ext}")
+        # 直接按 1 MiB 块把上传流拷到磁盘，不经过 FileStorage.save 的额外缓冲
+        with open(save_path, "wb") as out:
+            shutil.copyfileobj(file.stream, out, UPLOAD_CHUNK_SIZE)
 
         print(f"[upload_bill] Saved file to: {save_path}")
 
-        text = extract_text_from_file(save_path)
-        print(f"[upload_bill] Extracted text length: {len(text) if text else 0}")
+        sweep_upload_jobs()
+        track_upload_job(job_id, submit_upload_job(save_path))
+        return fastjson({"job_id": job_id}), 202
+
+    except Exception as e:
+        import traceback
+        error_msg = f"Error processing file: {str(e)}"
+        print(f"[upload_bill] ERROR: {error_msg}")
+        print(traceback.format_exc())
+        return fastjson({"error": error_msg}), 500
 
-        if not text.strip():
-            return jsonify({"error": "could not extract text from file"}), 400
 
-        decoded = parse_bill_text(text)
-        print(f"[upload_bill] Parsed result: billed={decoded.get('billed_amount')}, owe={decoded.get('printed_owe')}")
-        return jsonify(decoded)
+@app.route("/api/upload_bill/<job_id>", methods=["GET"])
+def get_upload_result(job_id):
+    fut = _UPLOAD_JOBS.get(job_id)
+    if fut is None:
+        return fastjson({"error": "unknown job"}), 404
+    if not fut.done():
+        return fastjson({"job_id": job_id, "status": "pending"}), 202
 
+    # 结果只取一次，取完就从表里删掉
+    pop_upload_job(job_id)
+    try:
+        payload, status = fut.result()
+    except Exception as e:
+        # 后台进程本身挂掉（如 BrokenProcessPool）
+        error_msg = f"Error processing file: {str(e)}"
+        print(f"[upload_bill] ERROR: {error_msg}")
+        return fastjson({"error": error_msg}), 500
+    if status != 200:
+        return fastjson(payload), status
+
+    try:
+        decoded = parse_bill_text(payload["text"])
     except Exception as e:
         import traceback
         error_msg = f"Error processing file: {str(e)}"
         print(f"[upload_bill] ERROR: {error_msg}")
         print(traceback.format_exc())
-        return jsonify({"error": error_msg}), 500
+        return fastjson({"error": error_msg}), 500
+    print(f"[upload_bill] Parsed result: billed={decoded.get('billed_amount')}, owe={decoded.get('printed_owe')}")
+    return fastjson(decoded), 200
 
 
 if __name__ == "__main__":
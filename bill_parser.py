@@ -0,0 +1,357 @@
+"""
+账单文本解析：纯字符串 / 正则逻辑，不依赖 Flask。
+
+单独成模块以便用 mypyc 编译（见 Dockerfile）；未编译时按普通 Python 模块导入，行为一致。
+"""
+import functools
+import heapq
+import re
+from typing import Dict, List, NamedTuple, Tuple
+
+import ahocorasick  # type: ignore
+
+# 解析用正则：模块加载时编译一次，避免逐行调用时重复查 re 缓存
+_DATE_RE = re.compile(r"(\d{1,2}[/-]\d{1,2}[/-]\d{2,4}|\d{4}-\d{2}-\d{2})")
+_CPT_RE = re.compile(r"(CPT\s*\d{4,5})", re.IGNORECASE)
+# 金额：三种写法合成一个正则，一次 finditer 按命中的分组区分；整数/小数部分分组，直接算成分
+#   dollar: with dollar sign (most reliable) - e.g., $7,353.60
+#   plain:  without dollar sign but with decimal point - e.g., 7,353.60
+#   comma:  European/OCR format with comma as decimal - e.g., 7,353,60
+_AMOUNT_RE = re.compile(
+    r"\$\s*(?P<dollar>[0-9]+(?:,[0-9]{3})*)\.(?P<dollar_frac>[0-9]{2})"
+    r"|(?P<plain>[0-9]+(?:,[0-9]{3})*)\.(?P<plain_frac>[0-9]{2})"
+    r"|(?P<comma>[0-9]+(?:,[0-9]{3})*),(?P<comma_frac>[0-9]{2})\b"
+)
+# 合理金额范围（单位：分）：0 < x < $1,000,000
+_MAX_AMOUNT_CENTS = 100000000
+_FIVE_DIGIT_RE = re.compile(r"\b\d{5}\b")
+_DECIMAL_AMT_RE = re.compile(r"\d+\.\d{2}")
+_FOUR_TO_FIVE_RE = re.compile(r"\b\d{4,5}\b")
+
+# 关键字表：模块级 tuple，解析循环里不再每行新建 list
+# total charges / total amount / billed amount
+_BILLED_KWS = ("total charges", "total amount", "total billed", "billed amount", "total lab charges")
+# patient responsibility / amount due / you owe / please pay
+_OWE_KWS = ("amount due", "you owe", "amount you owe", "patient responsibility",
+            "balance due", "pay this amount", "amount owed", "total due", "your balance")
+# Special handling for "pay X now" pattern
+_PAY_NOW_KWS = ("pay now", "pay $")
+_ALLOWED_KWS = ("allowed amount", "plan allowed", "eligible amount")
+_PAID_KWS = ("insurance paid", "plan paid", "benefit paid", "insurance payment")
+_DOS_KWS = ("service date", "date of service", "dos", "visit date")
+# provider 猜测：排除 / 命中的词，各编成一个正则，每行一次 search
+_PROVIDER_NEG = ("Patient", "Insurance", "Billing", "Statement", "Account", "Invoice", "Guarantor")
+_PROVIDER_POS = ("Center", "Clinic", "Hospital", "Medical", "Imaging", "Health", "Care")
+_PROVIDER_NEG_RE = re.compile("|".join(map(re.escape, _PROVIDER_NEG)))
+_PROVIDER_POS_RE = re.compile("|".join(map(re.escape, _PROVIDER_POS)))
+
+# 汇总行关键字：所有短语编进一个 Aho-Corasick 自动机，一次扫描得到命中的类别
+_TOTALS_KEYWORDS = {
+    "billed": _BILLED_KWS,
+    "owe": _OWE_KWS + _PAY_NOW_KWS,
+    "allowed": _ALLOWED_KWS,
+    "paid": _PAID_KWS,
+}
+_TOTALS_AUTOMATON = ahocorasick.Automaton()
+for _category, _phrases in _TOTALS_KEYWORDS.items():
+    for _phrase in _phrases:
+        _TOTALS_AUTOMATON.add_word(_phrase, _category)
+_TOTALS_AUTOMATON.make_automaton()
+
+
+# -------- 金额匹配：允许逗号，统一成整数分（cents） --------
+def to_cents(whole: str, frac: str) -> int:
+    return int(whole.replace(",", "")) * 100 + int(frac)
+
+
+def split_amounts(line: str) -> Tuple[List[int], List[int]]:
+    """Scan a line once and return (dollar amounts, all amounts), both in cents."""
+    dollar_vals: List[int] = []
+    plain_vals: List[int] = []
+    comma_vals: List[int] = []
+    for m in _AMOUNT_RE.finditer(line):
+        if m.group("dollar") is not None:
+            dollar_vals.append(to_cents(m.group("dollar"), m.group("dollar_frac")))
+        elif m.group("plain") is not None:
+            plain_vals.append(to_cents(m.group("plain"), m.group("plain_frac")))
+        else:
+            # comma-as-decimal format (e.g., "7,353,60" -> 735360)
+            comma_vals.append(to_cents(m.group("comma"), m.group("comma_frac")))
+
+    dollar_vals = [v for v in dollar_vals if 0 < v < _MAX_AMOUNT_CENTS]
+    plain_vals = [v for v in plain_vals if 0 < v < _MAX_AMOUNT_CENTS]
+
+    # 整数分可以直接放进 set 精确去重
+    plain_seen = set(plain_vals)
+    for v in comma_vals:
+        if 0 < v < _MAX_AMOUNT_CENTS and v not in plain_seen:
+            plain_vals.append(v)
+            plain_seen.add(v)
+
+    # Combine, preferring dollar amounts
+    dollar_seen = set(dollar_vals)
+    all_vals = dollar_vals + [v for v in plain_vals if v not in dollar_seen]
+    return dollar_vals, all_vals
+
+
+# 每行只跑一遍正则，后续各个循环直接读缓存字段
+class LineInfo(NamedTuple):
+    text: str
+    lower: str
+    amounts: List[int]
+    dollar_amounts: List[int]
+    date: str
+    has_code: bool
+
+
+def scan_lines(lines: List[str]) -> List[LineInfo]:
+    infos: List[LineInfo] = []
+    for line in lines:
+        m = _DATE_RE.search(line)
+        dollar_vals, all_vals = split_amounts(line)
+        infos.append(LineInfo(
+            line,
+            line.lower(),
+            all_vals,
+            dollar_vals,
+            m.group(1) if m else "",
+            bool(_FOUR_TO_FIVE_RE.search(line)),
+        ))
+    return infos
+
+
+def parse_bill_text(text: str) -> dict:
+    """
+    规则解析 v3：
+    - 先按行预处理和分类
+    - 优先从“明细行”和“带关键字的 total 行”抓金额
+    - 尝试区分 service date / statement date
+    """
+    result: Dict[str, object] = dict(_parse_cached(text))
+    result["issues"] = list(result["issues"])  # type: ignore[call-overload]
+    result["raw_text"] = text
+    return result
+
+
+# 解析对 text 是纯函数：同一份账单（demo 里很常见）重复上传时直接命中缓存。
+# 缓存里存不可变的 tuple，调用方每次拿到的是新 dict，互不影响。
+@functools.lru_cache(maxsize=128)
+def _parse_cached(text: str) -> Tuple[Tuple[str, object], ...]:
+    lines_raw = text.splitlines()
+    # 每行只 strip 一次；小写形式在 scan_lines 里一并算好缓存在 LineInfo.lower
+    lines = [l for l in map(str.strip, lines_raw) if l]
+    infos = scan_lines(lines)
+
+    # -------- provider 猜测：header 前几行里像机构名的 --------
+    provider = ""
+    provider_candidates: List[str] = []
+    header_window = lines[:12]
+    for line in header_window:
+        if _PROVIDER_NEG_RE.search(line):
+            continue
+        if _PROVIDER_POS_RE.search(line):
+            provider_candidates.append(line)
+
+    if provider_candidates:
+        provider = min(provider_candidates, key=len)
+
+    # -------- 日期解析：优先带 service/visit 的行，其次任意日期 --------
+    service_date = ""
+    fallback_date = ""
+
+    for info in infos:
+        if not info.date:
+            continue
+        d = info.date
+        if any(k in info.lower for k in _DOS_KWS):
+            service_date = d
+            break
+        if not fallback_date:
+            fallback_date = d
+
+    if not service_date:
+        service_date = fallback_date
+
+    # -------- procedure / CPT：优先 CPT xxx，其次 5 位代码出现在明细行 --------
+    cpt_match = _CPT_RE.search(text)
+    procedure = ""
+    if cpt_match:
+        procedure = cpt_match.group(1)
+    else:
+        # 没有显式 CPT，就找一行里有 5 位数字 + 金额的行
+        code_line = ""
+        for line in lines:
+            if _FIVE_DIGIT_RE.search(line) and _DECIMAL_AMT_RE.search(line):
+                code_line = line
+                break
+        if code_line:
+            m = _FIVE_DIGIT_RE.search(code_line)
+            if m:
+                procedure = m.group(0)
+
+    if not procedure:
+        procedure = "Unknown procedure"
+
+    all_amounts: List[int] = []
+    for info in infos:
+        all_amounts.extend(info.amounts)
+
+    all_amounts_clean = all_amounts[:]
+
+    # 以下金额均为整数分，只在生成结果时换算回美元
+    billed_amount = 0
+    allowed_amount = 0
+    printed_owe = 0
+    insurer_paid = 0
+
+    # -------- 先找 total / amount due / allowed / plan paid 等聚合行 --------
+    # For patient owe, prefer dollar-sign amounts (more reliable with OCR)
+    printed_owe_candidates: List[Tuple[str, int, str]] = []
+
+    for info in infos:
+        line = info.text
+        lower = info.lower
+        vals = info.amounts
+        if not vals:
+            continue
+
+        cats = {cat for _, cat in _TOTALS_AUTOMATON.iter(lower)}
+
+        if "billed" in cats:
+            cand = max(vals)
+            if cand > billed_amount:
+                billed_amount = cand
+
+        if "owe" in cats:
+            # Prefer dollar amounts for payment lines (more reliable)
+            dollar_vals = info.dollar_amounts
+            if dollar_vals:
+                # Dollar amount found - use it
+                printed_owe_candidates.append(('dollar', max(dollar_vals), line))
+            elif vals:
+                # No dollar amount, use plain amount
+                printed_owe_candidates.append(('plain', max(vals), line))
+
+        if "allowed" in cats:
+            cand = max(vals)
+            if cand > allowed_amount:
+                allowed_amount = cand
+
+        if "paid" in cats:
+            cand = max(vals)
+            if cand > insurer_paid:
+                insurer_paid = cand
+
+    # Select best printed_owe: prefer dollar amounts over plain amounts
+    dollar_candidates = [(amt, line) for (typ, amt, line) in printed_owe_candidates if typ == 'dollar']
+    plain_candidates = [(amt, line) for (typ, amt, line) in printed_owe_candidates if typ == 'plain']
+
+    if dollar_candidates:
+        # Use the dollar amount - if multiple, use the one from most specific context
+        printed_owe = max([amt for (amt, _) in dollar_candidates])
+    elif plain_candidates:
+        printed_owe = max([amt for (amt, _) in plain_candidates])
+
+    # -------- 再看“明细行”：行里同时有日期 + 代码 + 多个金额 --------
+    detail_lines: List[LineInfo] = []
+    for info in infos:
+        if info.date and info.has_code and len(info.amounts) >= 2:
+            detail_lines.append(info)
+
+    # 针对第一条明细行：通常格式类似
+    # [date] [code] [desc...] [charge] [allowed] [plan paid] [you owe]
+    if detail_lines:
+        vals = detail_lines[0].amounts
+        # 简单假设：最后一个是 you owe，倒数第二个是 plan paid，中间某个是 allowed，第一个最大的当 billed
+        if vals:
+            if billed_amount == 0:
+                billed_candidate = max(vals)
+                billed_amount = billed_candidate
+
+            # 可能结构：[charge, allowed, plan_paid, you_owe]
+            if len(vals) >= 4:
+                if printed_owe == 0:
+                    printed_owe = vals[-1]
+                if insurer_paid == 0:
+                    insurer_paid = vals[-2]
+                if allowed_amount == 0:
+                    allowed_amount = vals[-3]
+            elif len(vals) == 3:
+                # 结构可能是 [charge, plan_paid, you_owe]
+                if printed_owe == 0:
+                    printed_owe = vals[-1]
+                if insurer_paid == 0:
+                    insurer_paid = vals[-2]
+            elif len(vals) == 2:
+                # 最简单：[charge, you_owe]
+                if printed_owe == 0:
+                    printed_owe = vals[-1]
+
+    # -------- 没抓到就回退到全局逻辑 --------
+    # Filter out amounts that appear near account/reference numbers
+    # Account numbers often have amounts that look like prices
+    reasonable_amounts = [a for a in all_amounts_clean if a < 5000000]  # Most medical bills < $50k
+
+    if reasonable_amounts:
+        if billed_amount == 0:
+            # If we already found printed_owe, use a reasonable multiple of it
+            if printed_owe > 0:
+                # billed is typically higher than patient owes, but not by crazy amounts
+                candidates = [a for a in reasonable_amounts if a >= printed_owe and a <= printed_owe * 5]
+                if candidates:
+                    billed_amount = min(candidates)  # Take the smallest reasonable candidate
+                else:
+                    billed_amount = printed_owe  # Fallback to printed_owe
+            else:
+                billed_amount = max(reasonable_amounts)
+
+        if printed_owe == 0:
+            # 只要第二大的值，不必整体排序
+            top2 = heapq.nlargest(2, reasonable_amounts)
+            printed_owe = top2[1] if len(top2) > 1 else billed_amount
+
+    # 比例换算用整数运算，四舍五入到分：(x * pct + 50) // 100
+    if allowed_amount == 0 and billed_amount > 0:
+        allowed_amount = (billed_amount * 65 + 50) // 100
+
+    if insurer_paid == 0 and allowed_amount > 0:
+        coinsurance_pct = 20
+        insurer_paid = max(0, (allowed_amount * (100 - coinsurance_pct) + 50) // 100)
+
+    if printed_owe == 0:
+        printed_owe = billed_amount
+
+    # -------- 计算 should_owe 和 overcharge --------
+    # For statements/bills where we only see "amount due", the overcharge estimate
+    # is based on comparing to typical allowed amounts
+    coinsurance_pct = 20
+    if allowed_amount > 0 and billed_amount > allowed_amount:
+        # We have both billed and allowed - can calculate proper should_owe
+        should_owe = (allowed_amount * coinsurance_pct + 50) // 100
+    elif billed_amount > 0:
+        # We only have billed amount - estimate allowed as 65% of billed
+        should_owe = (billed_amount * 65 * coinsurance_pct + 5000) // 10000
+    else:
+        should_owe = 0
+
+    estimated_overcharge = max(0, printed_owe - should_owe)
+
+    issues: List[str] = []
+    if allowed_amount > 0 and billed_amount * 2 > allowed_amount * 3:
+        issues.append("Billed amount appears significantly higher than a typical allowed amount.")
+    if estimated_overcharge > 0:
+        issues.append("Patient responsibility looks higher than expected for a typical coinsurance rate.")
+
+    result: Dict[str, object] = {
+        "provider": provider or "Unknown provider",
+        "service_date": service_date or "Unknown date",
+        "procedure": procedure or "Unknown procedure",
+        "billed_amount": billed_amount / 100,
+        "allowed_amount": allowed_amount / 100,
+        "insurer_paid": insurer_paid / 100,
+        "printed_owe": printed_owe / 100,
+        "should_owe": should_owe / 100,
+        "estimated_overcharge": estimated_overcharge / 100,
+        "issues": tuple(issues),
+    }
+    return tuple(result.items())